@@ -15,43 +15,245 @@
 #   maybe use an entry point to allow further initialisation of the clone.
 
 import argparse
+import contextlib
 import glob
 import hashlib
-import http.client
+import json
 import os
 import os.path
+import re
 import shutil
 import subprocess
 import sys
+import tarfile
 import tempfile
+import time
 import venv
 
+# Our own source, part of the env hash and copied by `init`.
+with open(__file__, "rb") as _f:
+    _SELF_BYTES = _f.read()
+
+# Packaging tools that `pip freeze` leaves out of its output, we do the same.
+FREEZE_EXCLUDES = {"pip"}
+if sys.version_info < (3, 12):
+    # Newer Pythons don't install these into venvs, so pip freeze only
+    # hides them on older ones.
+    FREEZE_EXCLUDES.update(["setuptools", "wheel", "distribute"])
+
+# Shared by all HTTPS connections, see https_connection().
+_SSL_CONTEXT = None
+
+# Seconds after which we look for a newer pip wheel.
+PIP_WHEEL_MAX_AGE = 24 * 60 * 60
+
+# The project name (and whether a URL follows) of a requirement line and
+# trailing comments in requirements.txt.
+_REQ_RE = re.compile(
+    r"\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[[^\]]*\])?\s*(@)?")
+_COMMENT_RE = re.compile(r"(^|\s+)#.*$")
+
+# Stdlib modules needed to bootstrap pip in a venv that broken distributions
+# (e.g. Debian) ship separately, mapped to what we import to check for them.
+OVERLAY_MODULES = {"ensurepip": "ensurepip"}
+if sys.version_info < (3, 12):
+    # distutils was removed from the stdlib in Python 3.12.
+    OVERLAY_MODULES["distutils"] = "distutils.util"
+
 
 def cmd(c, merge_stderr=True, quiet=False):
     # TODO revisit the cmd() architecture w/ python 3
     # XXX better IO management for interactive output and seeing original
     # errors and output at appropriate places ...
+    # `c` is an argv list, we do not go through a shell.
     try:
-        kwargs = {"shell": True}
+        # Our own file descriptors are non-inheritable anyway (PEP 446).
+        # Not asking to close them allows subprocess to use posix_spawn()
+        # instead of fork() + closing every possible descriptor.
+        kwargs = {"stdout": subprocess.PIPE, "check": True, "close_fds": False}
         if merge_stderr:
             kwargs["stderr"] = subprocess.STDOUT
-        return subprocess.check_output([c], **kwargs)
+        return subprocess.run(c, **kwargs).stdout
     except subprocess.CalledProcessError as e:
-        print("{} returned with exit code {}".format(c, e.returncode))
+        print("{} returned with exit code {}".format(" ".join(c),
+                                                     e.returncode))
         print(e.output.decode("utf-8", "replace"))
         raise ValueError(e.output.decode("utf-8", "replace"))
 
 
-def get(host, path, f):
-    conn = http.client.HTTPSConnection(host)
-    conn.request("GET", path)
-    r1 = conn.getresponse()
-    assert r1.status == 200, (r1.status, host, path, r1.read()[:100])
-    chunk = r1.read(16 * 1024)
-    while chunk:
-        f.write(chunk)
-        chunk = r1.read(16 * 1024)
-    conn.close()
+def _rmtree(path):
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def https_connection(host):
+    global _SSL_CONTEXT
+    # Importing http.client and ssl as well as creating a context (which
+    # loads the CA certificates) is expensive, only do it when we actually
+    # download something.
+    import http.client
+    import ssl
+    if _SSL_CONTEXT is None:
+        _SSL_CONTEXT = ssl.create_default_context()
+    return http.client.HTTPSConnection(host, context=_SSL_CONTEXT)
+
+
+@contextlib.contextmanager
+def get(host, path, conn=None):
+    # Pass a connection from https_connection() to issue multiple requests
+    # over the same connection (HTTP keep-alive).
+    own_conn = conn is None
+    if own_conn:
+        conn = https_connection(host)
+    try:
+        conn.request("GET", path)
+        r1 = conn.getresponse()
+        assert r1.status == 200, (r1.status, host, path, r1.read()[:100])
+        yield r1
+        if not own_conn:
+            # The response needs to be consumed before the connection can
+            # be used again.
+            r1.read()
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def ensure_overlay(version):
+    # Provide the OVERLAY_MODULES of the given Python version from its source
+    # distribution. The result is cached in ~/.appenv/overlay so that we only
+    # download once per Python version instead of once per venv.
+    overlay = os.path.expanduser(
+        os.path.join("~", ".appenv", "overlay", version))
+    if os.path.isdir(overlay):
+        return overlay
+
+    os.makedirs(os.path.dirname(overlay), exist_ok=True)
+    # Build the overlay next to its final location and move it into place
+    # atomically to avoid leaving a half-populated cache behind.
+    tmp_base = tempfile.mkdtemp(dir=os.path.dirname(overlay))
+    try:
+        # Stream the tarball and only extract the modules we need instead of
+        # storing and unpacking the whole source distribution.
+        prefix = "Python-{}/".format(version)
+        wanted = tuple("{}Lib/{}/".format(prefix, module)
+                       for module in OVERLAY_MODULES)
+        extract_args = {}
+        if hasattr(tarfile, "data_filter"):
+            extract_args["filter"] = "data"
+        with get("www.python.org",
+                 "/ftp/python/{v}/Python-{v}.tgz".format(v=version)) as r:
+            # Read the response in large chunks: the default stream buffer
+            # of 10KiB causes a lot of small reads for a ~25MB download.
+            with tarfile.open(
+                    fileobj=r, mode="r|gz", bufsize=1024 * 1024) as tf:
+                for member in tf:
+                    if not member.name.startswith(wanted):
+                        continue
+                    member.name = member.name[len(prefix):]
+                    tf.extract(member, tmp_base, **extract_args)
+
+        assert os.path.exists(os.path.join(tmp_base, "Lib", "ensurepip"))
+        try:
+            os.rename(tmp_base, overlay)
+        except OSError:
+            # Another process populated the overlay concurrently.
+            if not os.path.isdir(overlay):
+                raise
+    finally:
+        _rmtree(tmp_base)
+    return overlay
+
+
+def pip_version(target):
+    # Return (major, minor) of the pip installed in the venv at `target`.
+    for info in glob.glob(
+            os.path.join(target, "lib", "python*", "site-packages",
+                         "pip-*.dist-info")):
+        m = re.match(r"pip-(\d+)\.(\d+)", os.path.basename(info))
+        if m:
+            return int(m.group(1)), int(m.group(2))
+    return (0, 0)
+
+
+def normalize_name(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _parse_req(line):
+    # Return the normalized project name of a requirement line and whether
+    # it is a direct URL reference (`name @ url`), or None if the line isn't
+    # a plain requirement.
+    m = _REQ_RE.match(line)
+    if not m:
+        return None
+    return normalize_name(m.group(1)), bool(m.group(2))
+
+
+def installed_distributions(site_packages):
+    # Yield (name, version) of the distributions installed in the given
+    # site-packages directories by reading their metadata directly. Used
+    # instead of `pip install --report` for pip versions before 22.2.
+    # Only needed on this rarely used code path, keep it off the startup.
+    import email.parser
+    parser = email.parser.HeaderParser()
+    for path in site_packages:
+        for info in sorted(
+                glob.glob(os.path.join(path, "*.dist-info")) +
+                glob.glob(os.path.join(path, "*.egg-info"))):
+            direct_url = os.path.join(info, "direct_url.json")
+            if os.path.exists(direct_url):
+                with open(direct_url) as f:
+                    if json.load(f).get("dir_info", {}).get("editable"):
+                        # We'd like to pick up the original -e statement.
+                        continue
+            if info.endswith(".dist-info"):
+                metadata = os.path.join(info, "METADATA")
+            elif os.path.isdir(info):
+                metadata = os.path.join(info, "PKG-INFO")
+            else:
+                metadata = info
+            with open(metadata, encoding="utf-8", errors="replace") as f:
+                headers = parser.parse(f)
+            yield headers["Name"], headers["Version"]
+
+
+def ensure_pip_wheel(python):
+    # Keep the newest pip wheel for this Python version in the overlay so
+    # that new venvs don't need to ask PyPI every time. Refreshed daily.
+    cache = os.path.expanduser(
+        os.path.join("~", ".appenv", "overlay", "pip",
+                     "{}.{}".format(*sys.version_info[:2])))
+    wheels = glob.glob(os.path.join(cache, "pip-*.whl"))
+    if wheels and time.time() - os.stat(cache).st_mtime < PIP_WHEEL_MAX_AGE:
+        return wheels[0]
+
+    os.makedirs(os.path.dirname(cache), exist_ok=True)
+    tmp_base = tempfile.mkdtemp(dir=os.path.dirname(cache))
+    try:
+        try:
+            cmd([
+                python, "-m", "pip", "download", "--no-deps", "--dest",
+                tmp_base, "pip"])
+        except ValueError:
+            if not wheels:
+                raise
+            # E.g. when offline: the wheel we already have still works.
+            print("Could not refresh pip, using cached {}".format(
+                os.path.basename(wheels[0])))
+            return wheels[0]
+        # Another process may replace the cache right after we put ours in
+        # place, so don't look for the wheel there afterwards.
+        (wheel,) = os.listdir(tmp_base)
+        _rmtree(cache)
+        try:
+            os.rename(tmp_base, cache)
+        except OSError:
+            # Another process refreshed the cache concurrently.
+            if not os.path.isdir(cache):
+                raise
+    finally:
+        _rmtree(tmp_base)
+    return os.path.join(cache, wheel)
 
 
 def ensure_venv(target):
@@ -62,66 +264,102 @@ def ensure_venv(target):
 
     if os.path.exists(target):
         print("Deleting unclean target)")
-        cmd("rm -rf {target}".format(target=target))
+        _rmtree(target)
 
     version = sys.version.split()[0]
     python_maj_min = ".".join(str(x) for x in sys.version_info[:2])
     print("Creating venv ...")
     venv.create(target, with_pip=False)
 
-    try:
-        # This is trying to detect whether we're on a proper Python stdlib
-        # or on a broken Debian. See various StackOverflow questions about
-        # this.
-        import distutils.util  # noqa: F401 imported but unused
-        import ensurepip  # noqa: F401 imported but unused
-    except ImportError:
+    # This is trying to detect whether we're on a proper Python stdlib or on
+    # a broken Debian. See various StackOverflow questions about this. Ask
+    # the venv itself as that is what needs to work.
+    python = os.path.join(target, "bin", "python")
+    probe = subprocess.run(
+        [python, "-c", "import " + ", ".join(OVERLAY_MODULES.values())],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    if probe.returncode != 0:
         # Okay, lets repair this, if we can. May need privilege escalation
         # at some point.
         # We could do: apt-get -y -q install python3-distutils python3-venv
         # on some systems but it requires root and is specific to Debian.
         # I decided to go a more sledge hammer route.
 
-        # XXX we can speed this up by storing this in ~/.appenv/overlay instead
-        # of doing the download for every venv we manage
         print("Activating broken distutils/ensurepip stdlib workaround ...")
 
-        tmp_base = tempfile.mkdtemp()
-        try:
-            download = os.path.join(tmp_base, "download.tar.gz")
-            with open(download, mode="wb") as f:
-                get("www.python.org",
-                    "/ftp/python/{v}/Python-{v}.tgz".format(v=version), f)
-
-            cmd("tar xf {} -C {}".format(download, tmp_base))
-
-            assert os.path.exists(
-                os.path.join(tmp_base, "Python-{}".format(version)))
-            for module in ["ensurepip", "distutils"]:
-                print(module)
-                shutil.copytree(
-                    os.path.join(tmp_base, "Python-{}".format(version), "Lib",
-                                 module),
-                    os.path.join(target, "lib",
-                                 "python{}.{}".format(*sys.version_info[:2]),
-                                 "site-packages", module))
-
-            # (always) prepend the site packages so we can actually have a
-            # fixed distutils installation.
-            site_packages = os.path.abspath(
-                os.path.join(target, "lib", "python" + python_maj_min,
-                             "site-packages"))
-            with open(os.path.join(site_packages, "batou.pth"), "w") as f:
-                f.write("import sys; sys.path.insert(0, '{}')\n".format(
-                    site_packages))
-
-        finally:
-            shutil.rmtree(tmp_base)
+        overlay = ensure_overlay(version)
+        for module in OVERLAY_MODULES:
+            print(module)
+            shutil.copytree(
+                os.path.join(overlay, "Lib", module),
+                os.path.join(target, "lib",
+                             "python{}.{}".format(*sys.version_info[:2]),
+                             "site-packages", module))
+
+        # (always) prepend the site packages so we can actually have a
+        # fixed distutils installation.
+        site_packages = os.path.abspath(
+            os.path.join(target, "lib", "python" + python_maj_min,
+                         "site-packages"))
+        # Use repr() to properly quote paths containing quotes or
+        # backslashes.
+        content = "import sys; sys.path.insert(0, {!r})\n".format(
+            site_packages).encode("utf-8")
+        with open(os.path.join(site_packages, "batou.pth"), "wb") as f:
+            f.write(content)
 
     print("Ensuring pip ...")
-    cmd("{target}/bin/python -m ensurepip --default-pip".format(target=target))
-    cmd("{target}/bin/python -m pip install --upgrade pip".format(
-        target=target))
+    cmd([python, "-m", "ensurepip", "--default-pip"])
+    # Upgrade pip from a cached wheel unless ensurepip already installed
+    # that version. Wheels are named like pip-24.0-py3-none-any.whl.
+    wheel = ensure_pip_wheel(python)
+    dist_info = "-".join(os.path.basename(wheel).split("-")[:2]) + ".dist-info"
+    if not os.path.exists(
+            os.path.join(target, "lib", "python" + python_maj_min,
+                         "site-packages", dist_info)):
+        cmd([python, "-m", "pip", "install", "--upgrade", "--no-index", wheel])
+
+
+def _is_executable(python):
+    return os.path.isfile(python) and os.access(python, os.X_OK)
+
+
+def _probe_python(python):
+    # Check whether this Python actually works. Being executable is not
+    # enough: pyenv shims or interpreters with missing shared libraries only
+    # fail once started. Don't spawn anything for files we can't execute.
+    if not _is_executable(python):
+        return False
+    try:
+        subprocess.check_call([python, "-c", "print(1)"],
+                              stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+def _exec_python(python):
+    # Only returns if the given Python could not be executed.
+    argv = [os.path.basename(python)] + sys.argv
+    os.environ["APPENV_BEST_PYTHON"] = python
+    try:
+        os.execv(python, argv)
+    except OSError:
+        del os.environ["APPENV_BEST_PYTHON"]
+
+
+def _remember_best_python(cache, key, python):
+    # The cache is an optimization only, don't fail if we can't write it.
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        tmp = "{}.{}".format(cache, os.getpid())
+        with open(tmp, "w") as f:
+            f.write("{}\n{}\n".format(key, python))
+        os.replace(tmp, cache)
+    except OSError:
+        pass
 
 
 def ensure_minimal_python():
@@ -156,17 +394,9 @@ def ensure_minimal_python():
         if python == current_python:
             # found a preferred python and we're already running as it
             break
-        # Try whether this Python works
-        try:
-            subprocess.check_call([python, "-c", "print(1)"],
-                                  stdout=subprocess.DEVNULL,
-                                  stderr=subprocess.DEVNULL)
-        except subprocess.CalledProcessError:
+        if not _probe_python(python):
             continue
-
-        argv = [os.path.basename(python)] + sys.argv
-        os.environ["APPENV_BEST_PYTHON"] = python
-        os.execv(python, argv)
+        _exec_python(python)
     else:
         print("Could not find the minimal preferred Python version.")
         print("To ensure a working requirements.lock on all Python versions")
@@ -200,6 +430,36 @@ def ensure_best_python(base):
                 break
 
     current_python = os.path.realpath(sys.executable)
+
+    # Searching the PATH and probing interpreters is expensive compared to
+    # the rest of a typical invocation. Remember the result for a given PATH
+    # and preferences. Installing a new interpreter changes the mtime of its
+    # directory, so include those to notice new Pythons. Only the latest
+    # result is kept.
+    path = os.environ.get("PATH", "")
+    key = hashlib.sha1(os.fsencode(path))
+    key.update(b"\0" + ",".join(preferences).encode("utf-8"))
+    for directory in path.split(os.pathsep):
+        try:
+            key.update(str(os.stat(directory).st_mtime_ns).encode("ascii"))
+        except OSError:
+            key.update(b"-")
+    key = key.hexdigest()
+    cache = os.path.expanduser(
+        os.path.join("~", ".cache", "appenv", "best-python"))
+    try:
+        with open(cache) as f:
+            cached_key, python = f.read().splitlines()
+    except (OSError, ValueError):
+        cached_key = python = None
+    if cached_key != key:
+        python = None
+    if python == current_python:
+        return
+    # Only Pythons that passed the probe get cached, don't start them twice.
+    if python and _is_executable(python):
+        _exec_python(python)
+
     for version in preferences:
         python = shutil.which("python{}".format(version))
         if not python:
@@ -208,17 +468,12 @@ def ensure_best_python(base):
         python = os.path.realpath(python)
         if python == current_python:
             # found a preferred python and we're already running as it
+            _remember_best_python(cache, key, python)
             break
-        # Try whether this Python works
-        try:
-            subprocess.check_call([python, "-c", "print(1)"],
-                                  stdout=subprocess.DEVNULL,
-                                  stderr=subprocess.DEVNULL)
-        except subprocess.CalledProcessError:
+        if not _probe_python(python):
             continue
-        argv = [os.path.basename(python)] + sys.argv
-        os.environ["APPENV_BEST_PYTHON"] = python
-        os.execv(python, argv)
+        _remember_best_python(cache, key, python)
+        _exec_python(python)
     else:
         print("Could not find a preferred Python version.")
         print("Preferences: {}".format(', '.join(preferences)))
@@ -309,6 +564,41 @@ class AppEnv(object):
             hash_content = f.read()
         return hashlib.new("sha256", hash_content).hexdigest()
 
+    def _expired_paths(self, whitelist):
+        if not os.path.isdir(self.appenv_dir):
+            return []
+        expired = []
+        with os.scandir(self.appenv_dir) as entries:
+            for entry in entries:
+                if entry.path in whitelist or entry.name.startswith("."):
+                    continue
+                expired.append(entry)
+        return expired
+
+    def _remove_expired_paths(self, expired):
+        for entry in expired:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+
+    def _create_env(self, env_dir, requirements):
+        ensure_venv(env_dir)
+
+        with open(os.path.join(env_dir, "requirements.lock"), "wb") as f:
+            f.write(requirements)
+
+        print("Installing ...")
+        python = os.path.join(env_dir, "bin", "python")
+        cmd([
+            python, "-m", "pip", "install", "--no-deps", "-r",
+            os.path.join(env_dir, "requirements.lock")])
+
+        cmd([python, "-m", "pip", "check"])
+
+        with open(os.path.join(env_dir, "appenv.ready"), "w") as f:
+            f.write("Ready or not, here I come, you can't hide\n")
+
     def _prepare(self):
         # copy used requirements.txt into the target directory so we can use
         # that to check later
@@ -319,24 +609,21 @@ class AppEnv(object):
 
         self._assert_requirements_lock()
 
-        hash_content = []
-        requirements = open("requirements.lock", "rb").read()
-        hash_content.append(os.fsencode(os.path.realpath(sys.executable)))
-        hash_content.append(requirements)
-        hash_content.append(open(__file__, "rb").read())
-        env_hash = hashlib.new("sha256",
-                               b"".join(hash_content)).hexdigest()[:8]
+        with open("requirements.lock", "rb") as f:
+            requirements = f.read()
+        # The env hash is only a cache key for the directory name, not a
+        # security measure, so a short and fast digest is fine.
+        env_hash = hashlib.blake2b(digest_size=4)
+        env_hash.update(os.fsencode(os.path.realpath(sys.executable)))
+        env_hash.update(requirements)
+        env_hash.update(_SELF_BYTES)
+        env_hash = env_hash.hexdigest()
         env_dir = os.path.join(self.appenv_dir, env_hash)
 
         whitelist = set([env_dir, os.path.join(self.appenv_dir, "unclean")])
-        for path in glob.glob(
-                "{appenv_dir}/*".format(appenv_dir=self.appenv_dir)):
-            if path not in whitelist:
-                print("Removing expired path: {path} ...".format(path=path))
-                if not os.path.isdir(path):
-                    os.unlink(path)
-                else:
-                    shutil.rmtree(path)
+        expired = self._expired_paths(whitelist)
+        for entry in expired:
+            print("Removing expired path: {path} ...".format(path=entry.path))
         if os.path.exists(env_dir):
             # check whether the existing environment is OK, it might be
             # nice to rebuild in a separate place if necessary to avoid
@@ -348,22 +635,20 @@ class AppEnv(object):
                     raise Exception()
             except Exception:
                 print("Existing envdir not consistent, deleting")
-                cmd("rm -rf {env_dir}".format(env_dir=env_dir))
-
-        if not os.path.exists(env_dir):
-            ensure_venv(env_dir)
-
-            with open(os.path.join(env_dir, "requirements.lock"), "wb") as f:
-                f.write(requirements)
-
-            print("Installing ...")
-            cmd("{env_dir}/bin/python -m pip install --no-deps -r"
-                " {env_dir}/requirements.lock".format(env_dir=env_dir))
-
-            cmd("{env_dir}/bin/python -m pip check".format(env_dir=env_dir))
-
-            with open(os.path.join(env_dir, "appenv.ready"), "w") as f:
-                f.write("Ready or not, here I come, you can't hide\n")
+                shutil.rmtree(env_dir)
+
+        if not os.path.exists(env_dir) and expired:
+            # Removing expired environments is independent from building the
+            # current one, so do it in the background.
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+                cleanup = pool.submit(self._remove_expired_paths, expired)
+                self._create_env(env_dir, requirements)
+                cleanup.result()
+        else:
+            self._remove_expired_paths(expired)
+            if not os.path.exists(env_dir):
+                self._create_env(env_dir, requirements)
 
         self.env_dir = env_dir
 
@@ -390,11 +675,9 @@ class AppEnv(object):
             os.makedirs(target)
         print()
         print("Creating appenv setup in {} ...".format(target))
-        with open(__file__, "rb") as bootstrap_file:
-            bootstrap_data = bootstrap_file.read()
         os.chdir(target)
         with open('appenv', "wb") as new_appenv:
-            new_appenv.write(bootstrap_data)
+            new_appenv.write(_SELF_BYTES)
         os.chmod('appenv', 0o755)
         if os.path.exists(command):
             os.unlink(command)
@@ -416,7 +699,7 @@ class AppEnv(object):
         print(
             "Resetting ALL application environments in {appenvdir} ...".format(
                 appenvdir=self.appenv_dir))
-        cmd("rm -rf {appenvdir}".format(appenvdir=self.appenv_dir))
+        _rmtree(self.appenv_dir)
 
     def update_lockfile(self, args=None, remaining=None):
         ensure_minimal_python()
@@ -424,37 +707,11 @@ class AppEnv(object):
         print("Updating lockfile")
         tmpdir = os.path.join(self.appenv_dir, "updatelock")
         if os.path.exists(tmpdir):
-            cmd("rm -rf {tmpdir}".format(tmpdir=tmpdir))
+            _rmtree(tmpdir)
         ensure_venv(tmpdir)
-        print("Installing packages ...")
-        cmd("{tmpdir}/bin/python -m pip install -r requirements.txt".format(
-            tmpdir=tmpdir))
-
-        # Hack because we might not have pkg_resources, but the venv should
-        tmp_paths = cmd(
-            "{tmpdir}/bin/python -c"
-            " 'import sys; print(\"\\n\".join(sys.path))'".format(
-                tmpdir=tmpdir),
-            merge_stderr=False).decode(sys.getfilesystemencoding())
-        for line in tmp_paths.splitlines():
-            line = line.strip()
-            if not line:
-                continue
-            sys.path.append(line)
-        import pkg_resources
 
         extra_specs = []
-        result = cmd(
-            "{tmpdir}/bin/python -m pip freeze".format(tmpdir=tmpdir),
-            merge_stderr=False).decode('ascii')
-        pinned_versions = {}
-        for line in result.splitlines():
-            if line.strip().startswith('-e '):
-                # We'd like to pick up the original -e statement here.
-                continue
-            spec = list(pkg_resources.parse_requirements(line))[0]
-            pinned_versions[spec.project_name] = spec
-        requested_versions = {}
+        requirements = []
         with open('requirements.txt') as f:
             for line in f.readlines():
                 if line.strip().startswith('-e '):
@@ -467,29 +724,71 @@ class AppEnv(object):
                 # filter comments, in particular # appenv-python-preferences
                 if line.strip().startswith('#'):
                     continue
-                spec = list(pkg_resources.parse_requirements(line))[0]
-                requested_versions[spec.project_name] = spec
+                line = _COMMENT_RE.sub("", line).strip()
+                if not line:
+                    continue
+                requirements.append(line)
+
+        python = os.path.join(tmpdir, "bin", "python")
+        if pip_version(tmpdir) >= (22, 2):
+            # pip >= 22.2 can report what it would install, so we get the
+            # resolved versions without installing anything.
+            print("Resolving packages ...")
+            report = json.loads(
+                cmd([
+                    python, "-m", "pip", "install", "--dry-run",
+                    "--ignore-installed", "--quiet", "--report", "-", "-r",
+                    "requirements.txt"],
+                    merge_stderr=False).decode("utf-8"))
+            distributions = []
+            for item in report["install"]:
+                if item["download_info"].get("dir_info", {}).get("editable"):
+                    # We'd like to pick up the original -e statement here.
+                    continue
+                distributions.append(
+                    (item["metadata"]["name"], item["metadata"]["version"]))
+        else:
+            print("Installing packages ...")
+            cmd([python, "-m", "pip", "install", "-r", "requirements.txt"])
+            distributions = installed_distributions(
+                glob.glob(
+                    os.path.join(tmpdir, "lib", "python*", "site-packages")))
+        pinned_versions = {}
+        for name, version in distributions:
+            if normalize_name(name) in FREEZE_EXCLUDES:
+                continue
+            pinned_versions[normalize_name(name)] = "{}=={}".format(
+                name, version)
+        requested_versions = {}
+        for line in requirements:
+            req = _parse_req(line)
+            # Only keep requirements with URLs, the others are taken
+            # from what the resolver picked.
+            if req and req[1]:
+                requested_versions[req[0]] = line
 
         final_versions = {}
-        for spec in requested_versions.values():
-            # Pick versions with URLs to ensure we don't get the screwed up
-            # results from pip freeze.
-            if spec.url:
-                final_versions[spec.project_name] = spec
-        for spec in pinned_versions.values():
+        # Pick versions with URLs to ensure we don't get the screwed up
+        # results from the resolver.
+        final_versions.update(requested_versions)
+        for name, spec in pinned_versions.items():
             # Ignore versions we already picked
-            if spec.project_name in final_versions:
+            if name in final_versions:
                 continue
-            final_versions[spec.project_name] = spec
-        lines = [str(spec) for spec in final_versions.values()]
+            final_versions[name] = spec
+        lines = list(final_versions.values())
         lines.extend(extra_specs)
         lines.sort()
-        with open(os.path.join(self.base, "requirements.lock"), "w") as f:
-            f.write('# appenv-requirements-hash: {}\n'.format(
-                self._hash_requirements()))
-            f.write('\n'.join(lines))
-            f.write('\n')
-        cmd("rm -rf {tmpdir}".format(tmpdir=tmpdir))
+        header = '# appenv-requirements-hash: {}'.format(
+            self._hash_requirements())
+        lines.insert(0, header)
+        # Write bytes to keep the file (and thus the env hash) identical
+        # across platforms and replace the old lockfile atomically.
+        lockfile = os.path.join(self.base, "requirements.lock")
+        with open(lockfile + ".tmp", "wb") as f:
+            f.write(('\n'.join(lines) + '\n').encode('utf-8'))
+        os.replace(lockfile + ".tmp", lockfile)
+        _rmtree(tmpdir)
 
 
 def main():
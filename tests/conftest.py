@@ -9,3 +9,13 @@ def workdir(tmpdir):
     os.chdir(str(tmpdir))
     yield str(tmpdir)
     os.chdir(old)
+
+
+@pytest.fixture(autouse=True)
+def home(tmpdir, monkeypatch):
+    # Keep appenv's caches (~/.appenv, ~/.cache/appenv) out of the
+    # developer's home directory.
+    home = os.path.join(str(tmpdir), "home")
+    os.mkdir(home)
+    monkeypatch.setenv("HOME", home)
+    yield home
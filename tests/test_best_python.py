@@ -0,0 +1,160 @@
+import appenv
+import os
+import sys
+import pytest
+import unittest.mock
+
+
+def test_best_python_is_cached(workdir, home, monkeypatch):
+    monkeypatch.delenv("APPENV_BEST_PYTHON", raising=False)
+    current_python = os.path.realpath(sys.executable)
+    with open("requirements.txt", "w") as f:
+        f.write("# appenv-python-preference: 3.99,3.98\n")
+
+    def which(name):
+        if name == "python3.99":
+            return None
+        return current_python
+
+    with unittest.mock.patch("shutil.which") as mock_which:
+        mock_which.side_effect = which
+        appenv.ensure_best_python(workdir)
+    assert mock_which.call_count == 2
+
+    cache_dir = os.path.join(home, ".cache", "appenv")
+    assert os.listdir(cache_dir) == ["best-python"]
+    with open(os.path.join(cache_dir, "best-python")) as f:
+        assert f.read().splitlines()[1] == current_python
+
+    # The second run does not search the PATH anymore.
+    with unittest.mock.patch("shutil.which") as mock_which:
+        appenv.ensure_best_python(workdir)
+    assert not mock_which.called
+
+
+def test_best_python_cache_exec(workdir, monkeypatch):
+    monkeypatch.delenv("APPENV_BEST_PYTHON", raising=False)
+    other_python = os.path.join(workdir, "python3.99")
+    with open(other_python, "w") as f:
+        f.write("#!/bin/sh\n")
+    os.chmod(other_python, 0o755)
+
+    class Exec(Exception):
+        pass
+
+    with unittest.mock.patch("shutil.which") as mock_which, \
+            unittest.mock.patch("os.execv") as execv:
+        mock_which.return_value = other_python
+        execv.side_effect = Exec()
+        with pytest.raises(Exec):
+            appenv.ensure_best_python(workdir)
+        assert execv.call_args[0][0] == other_python
+
+        assert os.environ["APPENV_BEST_PYTHON"] == other_python
+
+        monkeypatch.delenv("APPENV_BEST_PYTHON")
+        mock_which.reset_mock()
+        execv.reset_mock()
+        with pytest.raises(Exec):
+            appenv.ensure_best_python(workdir)
+        assert not mock_which.called
+        assert execv.call_args[0][0] == other_python
+
+
+def test_current_python_is_not_probed(workdir, monkeypatch):
+    monkeypatch.delenv("APPENV_BEST_PYTHON", raising=False)
+    current_python = os.path.realpath(sys.executable)
+
+    with unittest.mock.patch("shutil.which") as mock_which, \
+            unittest.mock.patch.object(
+                appenv, "_is_executable",
+                wraps=appenv._is_executable) as is_executable, \
+            unittest.mock.patch("os.execv") as execv:
+        mock_which.return_value = current_python
+        appenv.ensure_best_python(workdir)
+        # Found on the cached path the second time.
+        appenv.ensure_best_python(workdir)
+    assert mock_which.call_count == 1
+    assert not is_executable.called
+    assert not execv.called
+    assert "APPENV_BEST_PYTHON" not in os.environ
+
+
+def test_unusable_python_is_skipped(workdir, home, monkeypatch):
+    monkeypatch.delenv("APPENV_BEST_PYTHON", raising=False)
+    with open("requirements.txt", "w") as f:
+        f.write("# appenv-python-preference: 3.99,3.98,3.97\n")
+    # 3.99 is not executable, 3.98 is like a pyenv shim for a version that
+    # isn't installed.
+    scripts = {
+        "3.99": "",
+        "3.98": "#!/bin/sh\nexit 127\n",
+        "3.97": "#!/bin/sh\n"}
+    pythons = {}
+    for version, script in scripts.items():
+        pythons[version] = os.path.join(workdir, "python" + version)
+        with open(pythons[version], "w") as f:
+            f.write(script)
+    os.chmod(pythons["3.98"], 0o755)
+    os.chmod(pythons["3.97"], 0o755)
+
+    class Exec(Exception):
+        pass
+
+    with unittest.mock.patch("shutil.which") as mock_which, \
+            unittest.mock.patch("os.execv") as execv:
+        mock_which.side_effect = lambda name: pythons[name[len("python"):]]
+        execv.side_effect = Exec()
+        with pytest.raises(Exec):
+            appenv.ensure_best_python(workdir)
+    executed = [c[0][0] for c in execv.call_args_list]
+    assert executed == [pythons["3.97"]]
+    # Only the working Python is remembered.
+    with open(os.path.join(home, ".cache", "appenv", "best-python")) as f:
+        assert f.read().splitlines()[1] == pythons["3.97"]
+
+
+def test_broken_minimal_python_is_not_executed(workdir, monkeypatch):
+    monkeypatch.delenv("APPENV_BEST_PYTHON", raising=False)
+    with open("requirements.txt", "w") as f:
+        f.write("# appenv-python-preference: 3.99\n")
+    python = os.path.join(workdir, "python3.99")
+    with open(python, "w") as f:
+        f.write("#!/bin/sh\nexit 127\n")
+    os.chmod(python, 0o755)
+
+    with unittest.mock.patch("shutil.which") as mock_which, \
+            unittest.mock.patch("os.execv") as execv:
+        mock_which.return_value = python
+        with pytest.raises(SystemExit) as e:
+            appenv.ensure_minimal_python()
+    assert e.value.code == 66
+    assert not execv.called
+
+
+def test_best_python_cache_notices_new_python(workdir, home, monkeypatch):
+    monkeypatch.delenv("APPENV_BEST_PYTHON", raising=False)
+    bin_dir = os.path.join(workdir, "bin")
+    os.mkdir(bin_dir)
+    monkeypatch.setenv("PATH", bin_dir)
+    current_python = os.path.realpath(sys.executable)
+
+    with unittest.mock.patch("shutil.which") as mock_which:
+        mock_which.return_value = current_python
+        appenv.ensure_best_python(workdir)
+        assert mock_which.called
+
+        mock_which.reset_mock()
+        appenv.ensure_best_python(workdir)
+        assert not mock_which.called
+
+        # Installing another Python into a PATH directory invalidates the
+        # cached result.
+        with open(os.path.join(bin_dir, "python3.99"), "w"):
+            pass
+        os.utime(bin_dir, ns=(0, 0))
+        appenv.ensure_best_python(workdir)
+        assert mock_which.called
+    # The previous result is replaced instead of piling up.
+    cache_dir = os.path.join(home, ".cache", "appenv")
+    assert os.listdir(cache_dir) == ["best-python"]
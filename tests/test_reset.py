@@ -18,3 +18,25 @@ def test_reset_removes_envdir_with_subdirs(tmpdir):
     env.reset()
     assert not os.path.exists(env.appenv_dir)
     assert os.path.exists(str(tmpdir))
+
+
+def test_remove_expired_paths(tmpdir):
+    env = appenv.AppEnv(os.path.join(tmpdir, 'ducker'))
+    # Doesn't break if there is nothing to clean up.
+    assert env._expired_paths(set()) == []
+
+    current = os.path.join(env.appenv_dir, "12345678")
+    expired = os.path.join(env.appenv_dir, "87654321")
+    os.makedirs(os.path.join(current, "bin"))
+    os.makedirs(os.path.join(expired, "bin"))
+    with open(os.path.join(env.appenv_dir, "stray"), "w"):
+        pass
+    os.symlink(current, os.path.join(env.appenv_dir, "link"))
+
+    expired = env._expired_paths({current})
+    names = sorted(entry.name for entry in expired)
+    assert names == ["87654321", "link", "stray"]
+    env._remove_expired_paths(expired)
+
+    assert os.listdir(env.appenv_dir) == ["12345678"]
+    assert os.path.exists(os.path.join(current, "bin"))
@@ -16,8 +16,13 @@ def test_init_and_create_lockfile(workdir, monkeypatch):
     lockfile = os.path.join(workdir, "ducker", "requirements.lock")
     assert not os.path.exists(lockfile)
 
+    # Neither pkg_resources nor the temporary venv's sys.path is needed.
+    monkeypatch.setitem(sys.modules, "pkg_resources", None)
+    sys_path = list(sys.path)
+
     env.update_lockfile()
 
+    assert sys.path == sys_path
     assert os.path.exists(lockfile)
     with open(lockfile) as f:
         lockfile_content = f.read()
@@ -90,3 +95,74 @@ def test_update_lockfile_missing_minimal_python(workdir, monkeypatch):
         with pytest.raises(SystemExit) as e:
             env.update_lockfile()
     assert e.value.code == 66
+
+
+def test_installed_distributions(tmpdir):
+    site_packages = str(tmpdir)
+
+    def install(info, metadata, content, direct_url=None):
+        os.makedirs(os.path.join(site_packages, info))
+        with open(os.path.join(site_packages, info, metadata), "w") as f:
+            f.write(content)
+        if direct_url:
+            with open(
+                    os.path.join(site_packages, info, "direct_url.json"),
+                    "w") as f:
+                f.write(direct_url)
+
+    install("ducker-2.0.1.dist-info", "METADATA",
+            "Metadata-Version: 2.1\nName: ducker\nVersion: 2.0.1\n\nBody\n")
+    install(
+        "typing_extensions-4.0.0.dist-info", "METADATA",
+        "Metadata-Version: 2.1\nName: typing_extensions\n"
+        "Version: 4.0.0\n")
+    install("legacy-1.0-py3.6.egg-info", "PKG-INFO",
+            "Metadata-Version: 1.0\nName: legacy\nVersion: 1.0\n")
+    install("pip-23.0.dist-info", "METADATA",
+            "Metadata-Version: 2.1\nName: pip\nVersion: 23.0\n")
+    install("devel-0.1.dist-info", "METADATA",
+            "Metadata-Version: 2.1\nName: devel\nVersion: 0.1\n",
+            '{"url": "file:///src/devel", "dir_info": {"editable": true}}')
+
+    assert sorted(appenv.installed_distributions([site_packages])) == [
+        ("ducker", "2.0.1"), ("legacy", "1.0"), ("pip", "23.0"),
+        ("typing_extensions", "4.0.0")]
+
+
+def test_parse_req():
+    assert appenv._parse_req("ducker==2.0.1") == ("ducker", False)
+    assert appenv._parse_req("Typing_Extensions") == ("typing-extensions",
+                                                      False)
+    assert appenv._parse_req("requests[socks] >= 2.0 ; python_version>'3'") \
+        == ("requests", False)
+    assert appenv._parse_req(
+        "ducker @ https://example.com/ducker-2.0.1.tar.gz") == ("ducker", True)
+    assert appenv._parse_req("ducker[x]@git+https://example.com/ducker") == (
+        "ducker", True)
+    assert appenv._parse_req("./src/ducker") is None
+
+
+def test_update_lockfile_setuptools_dependency(workdir, monkeypatch):
+    """It keeps setuptools where pip freeze would, i.e. on Python 3.12+."""
+    monkeypatch.setattr('sys.stdin',
+                        io.StringIO('zope\nzope.interface==6.4\n\n'))
+
+    env = appenv.AppEnv(os.path.join(workdir, 'zope'))
+    env.init()
+    env.update_lockfile()
+
+    with open(os.path.join(workdir, "zope", "requirements.lock")) as f:
+        lockfile = f.read().splitlines()
+    assert "zope.interface==6.4" in lockfile
+    assert not any(line.startswith("pip==") for line in lockfile)
+    assert any(line.startswith("setuptools==") for line in lockfile) == (
+        sys.version_info >= (3, 12))
+
+
+def test_pip_version(tmpdir):
+    assert appenv.pip_version(str(tmpdir)) == (0, 0)
+    os.makedirs(
+        os.path.join(
+            str(tmpdir), "lib", "python3.6", "site-packages",
+            "pip-21.3.1.dist-info"))
+    assert appenv.pip_version(str(tmpdir)) == (21, 3)
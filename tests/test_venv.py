@@ -1,5 +1,11 @@
 import appenv
+import contextlib
 import os.path
+import pytest
+import sys
+import tarfile
+import time
+import unittest.mock
 
 
 def test_new_venv(tmpdir):
@@ -34,3 +40,105 @@ def test_new_broken_venv_recreated(tmpdir):
     assert os.path.exists(os.path.join(tmpdir, "venv", "bin", "python"))
     assert os.path.exists(os.path.join(tmpdir, "venv", "lib"))
     assert not os.path.exists(os.path.join(tmpdir, "venv", "asdf"))
+
+
+def test_overlay_is_downloaded_once(tmpdir, home, monkeypatch):
+    tmpdir = str(tmpdir)
+
+    source = os.path.join(tmpdir, "src", "Python-3.99.0", "Lib")
+    for module in ["ensurepip", "distutils", "json"]:
+        os.makedirs(os.path.join(source, module))
+        with open(os.path.join(source, module, "__init__.py"), "w"):
+            pass
+    tarball = os.path.join(tmpdir, "Python-3.99.0.tgz")
+    with tarfile.open(tarball, "w:gz") as tf:
+        tf.add(os.path.join(tmpdir, "src", "Python-3.99.0"), "Python-3.99.0")
+
+    downloads = []
+
+    @contextlib.contextmanager
+    def get(host, path):
+        downloads.append(path)
+        with open(tarball, "rb") as f:
+            yield f
+
+    monkeypatch.setattr(appenv, "get", get)
+
+    overlay = appenv.ensure_overlay("3.99.0")
+    assert overlay == os.path.join(home, ".appenv", "overlay", "3.99.0")
+    assert sorted(os.listdir(os.path.join(overlay, "Lib"))) == sorted(
+        appenv.OVERLAY_MODULES)
+    assert os.path.exists(
+        os.path.join(overlay, "Lib", "ensurepip", "__init__.py"))
+
+    assert appenv.ensure_overlay("3.99.0") == overlay
+    assert downloads == ["/ftp/python/3.99.0/Python-3.99.0.tgz"]
+    # No temporary directories are left behind.
+    assert os.listdir(os.path.dirname(overlay)) == ["3.99.0"]
+
+
+def test_pip_wheel_is_cached(tmpdir, home, monkeypatch):
+    tmpdir = str(tmpdir)
+    calls = []
+    cmd = appenv.cmd
+
+    def record_cmd(c, *args, **kw):
+        calls.append(c[1:4])
+        return cmd(c, *args, **kw)
+
+    monkeypatch.setattr(appenv, "cmd", record_cmd)
+
+    appenv.ensure_venv(os.path.join(tmpdir, "venv1"))
+    assert ["-m", "pip", "download"] in calls
+    cache = os.path.join(home, ".appenv", "overlay", "pip",
+                         "{}.{}".format(*sys.version_info[:2]))
+    (wheel,) = os.listdir(cache)
+    assert wheel.startswith("pip-")
+
+    del calls[:]
+    appenv.ensure_venv(os.path.join(tmpdir, "venv2"))
+    assert ["-m", "pip", "download"] not in calls
+    assert os.path.exists(os.path.join(tmpdir, "venv2", "bin", "pip3"))
+
+
+def test_get_reuses_connection():
+    conn = unittest.mock.Mock()
+    conn.getresponse.return_value.status = 200
+
+    with appenv.get("www.python.org", "/a", conn=conn) as r:
+        r.read(10)
+    with appenv.get("www.python.org", "/b", conn=conn):
+        pass
+
+    requests = [c[0] for c in conn.request.call_args_list]
+    assert requests == [("GET", "/a"), ("GET", "/b")]
+    # Responses are drained for the next request, the connection stays open.
+    assert conn.getresponse.return_value.read.call_args_list == [
+        unittest.mock.call(10),
+        unittest.mock.call(),
+        unittest.mock.call()]
+    assert not conn.close.called
+
+
+def test_pip_wheel_refresh_failure_uses_cache(tmpdir, home, monkeypatch):
+    tmpdir = str(tmpdir)
+    cache = os.path.join(home, ".appenv", "overlay", "pip",
+                         "{}.{}".format(*sys.version_info[:2]))
+    os.makedirs(cache)
+    wheel = os.path.join(cache, "pip-23.0-py3-none-any.whl")
+    with open(wheel, "w"):
+        pass
+    expired = time.time() - appenv.PIP_WHEEL_MAX_AGE - 1
+    os.utime(cache, (expired, expired))
+
+    def cmd(c, *args, **kw):
+        raise ValueError("offline")
+
+    monkeypatch.setattr(appenv, "cmd", cmd)
+    assert appenv.ensure_pip_wheel(sys.executable) == wheel
+    assert os.listdir(os.path.dirname(cache)) == [os.path.basename(cache)]
+
+    # Without a cached wheel the error is not hidden.
+    os.unlink(wheel)
+    with pytest.raises(ValueError):
+        appenv.ensure_pip_wheel(sys.executable)